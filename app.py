@@ -4,7 +4,16 @@ import os
 import time
 import re
 import json
+import uuid
+import random
+import socket
+import hashlib
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from urllib.parse import urlparse
 from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from waitress import serve
 
 app = Flask(__name__, static_folder='static', static_url_path='')
@@ -34,6 +43,53 @@ API_ACCESS_TOKEN = os.environ.get('API_ACCESS_TOKEN')
 MODEL_CALIBRATE = "s2t-calibrated"
 MODEL_SUMMARIZE = "s2t-summarized"
 
+# --- 启动预热与健康检查配置 ---
+_ENV_ERRORS = [] # 解析失败的环境变量，启动后由 _validate_config 作为配置错误汇报
+
+def _env_int(name, default):
+    # 数值型环境变量格式错误时回退默认值并记录，避免进程在配置校验前就因导入失败退出
+    value = os.environ.get(name)
+    if value is None or not value.strip(): return default
+    try:
+        return int(value)
+    except ValueError:
+        _ENV_ERRORS.append(f"环境变量 {name} ({value}) 不是有效整数，已使用默认值 {default}。")
+        return default
+
+UPSTREAM_POOL_SIZE = _env_int('UPSTREAM_POOL_SIZE', 10) # 每个上游的连接池大小
+STARTUP_PROBE_MODELS = os.environ.get('STARTUP_PROBE_MODELS', 'false').lower() in ('1', 'true', 'yes') # 启动时是否向各模型发送探测请求
+UPSTREAM_CHECK_TIMEOUT = 10 # 上游连通性检查超时(秒)
+UPSTREAM_CHECK_INTERVAL = 30 # 后台上游检查间隔(秒)，/readyz 只读取最近一次检查结果
+MODEL_PROBE_MAX_BACKOFF = 300 # 模型探测失败后重新探测的最大退避间隔(秒)
+# 默认只根据本实例自身状态(预热完成、配置无误)判定就绪；上游为所有实例共享，其故障会让全部实例同时摘除
+# 设为 true 时，上游不可达、返回 5xx 或模型探测失败也判定为未就绪
+READINESS_REQUIRE_UPSTREAMS = os.environ.get('READINESS_REQUIRE_UPSTREAMS', 'false').lower() in ('1', 'true', 'yes')
+
+# --- 上游连接池 ---
+# S2T 与 OPT 各自使用独立的 Session，复用 DNS 解析结果与 TLS 连接，避免每次请求重新握手
+def _create_pooled_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=UPSTREAM_POOL_SIZE)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+S2T_SESSION = _create_pooled_session()
+OPT_SESSION = _create_pooled_session()
+
+# --- 多实例协调配置 ---
+COORDINATION_BACKEND = os.environ.get('COORDINATION_BACKEND', 'memory').lower() # memory 或 redis
+REDIS_URL = os.environ.get('REDIS_URL')
+REDIS_KEY_PREFIX = os.environ.get('REDIS_KEY_PREFIX', 's2t:')
+REDIS_SOCKET_TIMEOUT = 2 # Redis 连接与读写超时(秒)，Redis 无响应时尽快抛错以触发降级
+UPSTREAM_MAX_CONCURRENCY = _env_int('UPSTREAM_MAX_CONCURRENCY', 0) # 每个上游全局最大并发，0 表示不限制
+UPSTREAM_RATE_LIMIT_RPM = _env_int('UPSTREAM_RATE_LIMIT_RPM', 0) # 每个上游全局每分钟请求数，0 表示不限制
+RESULT_CACHE_TTL = _env_int('RESULT_CACHE_TTL', 3600) # 结果缓存有效期(秒)，0 表示关闭缓存
+RESULT_CACHE_MAX_ENTRIES = 1000 # 进程内缓存最大条目数
+UPSTREAM_WAIT_TIMEOUT = _env_int('UPSTREAM_WAIT_TIMEOUT', 60) # 单次上游调用排队与限流的最长等待(秒)，超时后直接返回繁忙错误
+WAITRESS_THREADS = _env_int('WAITRESS_THREADS', 16) # Web 服务线程数，排队等待的请求会占用线程，需高于默认的 4
+JOB_LEASE_SECONDS = 30 # 队列条目心跳超时(秒)，超时未续约视为崩溃实例遗留的占位并清理
+
 # --- Prompts ---
 HARDCODED_OPTIMIZATION_PROMPT = """
 Description:
@@ -181,6 +237,350 @@ def _extract_api_error_message(response):
     except ValueError:
         return response.text[:200]
 
+# =============================================================
+# --- 多实例协调后端（任务队列 / 结果缓存 / 全局限流）---
+# =============================================================
+# memory：单进程内协调（默认）；redis：多个 app.py 实例通过同一 Redis 共享队列、缓存与限流
+# 各类均只依赖注入的 client，可用任意 Redis 兼容实现（如本地 stand-in）替代
+
+class UpstreamBusyError(Exception):
+    '''
+    排队或限流等待超过 UPSTREAM_WAIT_TIMEOUT，不再占用服务线程继续等待
+    '''
+
+class MemoryJobQueue:
+    '''
+    上游任务队列：按到达顺序排队，同一上游同时执行的任务数不超过 UPSTREAM_MAX_CONCURRENCY
+    '''
+    def __init__(self, max_concurrency):
+        self.max_concurrency = max_concurrency
+        self._condition = threading.Condition()
+        self._queues = {}
+
+    @contextmanager
+    def slot(self, upstream, deadline=None):
+        if self.max_concurrency <= 0:
+            yield
+            return
+        ticket = object()
+        with self._condition:
+            queue = self._queues.setdefault(upstream, [])
+            queue.append(ticket)
+            timeout = None if deadline is None else max(0, deadline - time.time())
+            if not self._condition.wait_for(lambda: queue.index(ticket) < self.max_concurrency, timeout):
+                queue.remove(ticket)
+                self._condition.notify_all()
+                raise UpstreamBusyError(f"上游 {upstream} 繁忙，排队等待超时")
+        try:
+            yield
+        finally:
+            with self._condition:
+                queue.remove(ticket)
+                self._condition.notify_all()
+
+class MemoryResultCache:
+    '''
+    结果缓存：带过期时间的 LRU，容量超过 RESULT_CACHE_MAX_ENTRIES 时淘汰最久未使用的条目
+    '''
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        if self.ttl <= 0: return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry: return None
+            value, expires_at = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if self.ttl <= 0: return
+        with self._lock:
+            self._entries[key] = (value, time.time() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+class MemoryRateLimiter:
+    '''
+    全局限流：滑动窗口，同一上游在任意连续 60 秒内最多发出 UPSTREAM_RATE_LIMIT_RPM 个请求
+    超出时等待窗口内最早的请求过期；固定窗口会在窗口交界处放行两倍配额，仍可能触发上游限流
+    '''
+    def __init__(self, limit_per_minute):
+        self.limit_per_minute = limit_per_minute
+        self._lock = threading.Lock()
+        self._requests = {}
+
+    def _try_acquire(self, upstream, now):
+        # 返回 0 表示已获取配额，否则返回需要等待的秒数
+        with self._lock:
+            window = self._requests.setdefault(upstream, deque())
+            while window and window[0] <= now - 60: window.popleft()
+            if len(window) < self.limit_per_minute:
+                window.append(now)
+                return 0
+            return window[0] + 60 - now
+
+    def acquire(self, upstream, deadline=None):
+        if self.limit_per_minute <= 0: return
+        while True:
+            now = time.time()
+            wait = self._try_acquire(upstream, now)
+            if wait <= 0: return
+            if deadline is not None and now + wait > deadline:
+                raise UpstreamBusyError(f"上游 {upstream} 已达速率上限，限流等待超时")
+            time.sleep(wait)
+
+class RedisJobQueue:
+    '''
+    基于有序集合的分布式任务队列
+    queue：等待中的任务，score 为入队时间，决定先后顺序
+    running：执行中的任务，只有其数量小于 max_concurrency 时队首任务才能转入，借助 WATCH 保证原子性
+    heartbeat：所有任务的最近心跳时间，等待和执行期间持续续约，超过 lease_seconds 未续约的条目视为崩溃实例遗留并被清理
+    '''
+    def __init__(self, client, prefix, max_concurrency, lease_seconds, poll_interval=0.2):
+        self.client = client
+        self.prefix = prefix
+        self.max_concurrency = max_concurrency
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+
+    def _keys(self, upstream):
+        return (f"{self.prefix}queue:{upstream}", f"{self.prefix}running:{upstream}", f"{self.prefix}heartbeat:{upstream}")
+
+    def _purge_expired(self, keys):
+        queue_key, running_key, heartbeat_key = keys
+        expired = self.client.zrangebyscore(heartbeat_key, '-inf', time.time() - self.lease_seconds)
+        if expired:
+            pipe = self.client.pipeline()
+            pipe.zrem(queue_key, *expired)
+            pipe.zrem(running_key, *expired)
+            pipe.zrem(heartbeat_key, *expired)
+            pipe.execute()
+
+    def _try_acquire(self, keys, member, enqueued_at):
+        from redis.exceptions import WatchError
+        queue_key, running_key, heartbeat_key = keys
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(running_key)
+                running = pipe.zcard(running_key)
+                rank = pipe.zrank(queue_key, member)
+                if rank is None or running + rank >= self.max_concurrency:
+                    # 续约等待条目；始终以原入队时间写回，即使曾被误清理也不会丢失排队位置
+                    pipe.multi()
+                    pipe.zadd(queue_key, {member: enqueued_at})
+                    pipe.zadd(heartbeat_key, {member: time.time()})
+                    pipe.execute()
+                    return False
+                pipe.multi()
+                pipe.zrem(queue_key, member)
+                pipe.zadd(running_key, {member: time.time()})
+                pipe.zadd(heartbeat_key, {member: time.time()})
+                pipe.execute()
+                return True
+            except WatchError:
+                # running 在读取后被其他实例修改，下一轮重新判断
+                return False
+
+    def _heartbeat(self, heartbeat_key, member, stop_event):
+        while not stop_event.wait(self.lease_seconds / 3):
+            try:
+                self.client.zadd(heartbeat_key, {member: time.time()})
+            except Exception as e:
+                print(f"任务队列心跳续约失败: {type(e).__name__} - {e}")
+
+    @contextmanager
+    def slot(self, upstream, deadline=None):
+        if self.max_concurrency <= 0:
+            yield
+            return
+        keys = self._keys(upstream)
+        queue_key, running_key, heartbeat_key = keys
+        member = uuid.uuid4().hex
+        enqueued_at = time.time()
+        stop_event = threading.Event()
+        try:
+            pipe = self.client.pipeline()
+            pipe.zadd(queue_key, {member: enqueued_at})
+            pipe.zadd(heartbeat_key, {member: enqueued_at})
+            pipe.execute()
+            while True:
+                self._purge_expired(keys)
+                if self._try_acquire(keys, member, enqueued_at): break
+                if deadline is not None and time.time() >= deadline:
+                    raise UpstreamBusyError(f"上游 {upstream} 繁忙，排队等待超时")
+                time.sleep(self.poll_interval)
+            threading.Thread(target=self._heartbeat, args=(heartbeat_key, member, stop_event), daemon=True).start()
+            yield
+        finally:
+            stop_event.set()
+            pipe = self.client.pipeline()
+            pipe.zrem(queue_key, member)
+            pipe.zrem(running_key, member)
+            pipe.zrem(heartbeat_key, member)
+            pipe.execute()
+
+class RedisResultCache:
+    def __init__(self, client, prefix, ttl):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def get(self, key):
+        if self.ttl <= 0: return None
+        value = self.client.get(f"{self.prefix}cache:{key}")
+        return value.decode('utf-8') if isinstance(value, bytes) else value
+
+    def set(self, key, value):
+        if self.ttl <= 0: return
+        self.client.set(f"{self.prefix}cache:{key}", value, ex=self.ttl)
+
+class RedisRateLimiter:
+    '''
+    基于有序集合的滑动窗口限流：每个请求以发出时间为 score 记入集合，借助 WATCH 保证多实例间计数原子
+    等待时附加随机抖动，避免各实例被阻塞的请求在同一时刻集中唤醒
+    '''
+    def __init__(self, client, prefix, limit_per_minute, max_jitter=0.2):
+        self.client = client
+        self.prefix = prefix
+        self.limit_per_minute = limit_per_minute
+        self.max_jitter = max_jitter
+
+    def _try_acquire(self, key, now):
+        # 返回 0 表示已获取配额，否则返回需要等待的秒数
+        from redis.exceptions import WatchError
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                count = pipe.zcount(key, f"({now - 60}", '+inf')
+                if count >= self.limit_per_minute:
+                    oldest = pipe.zrangebyscore(key, f"({now - 60}", '+inf', start=0, num=1, withscores=True)
+                    return oldest[0][1] + 60 - now if oldest else 0.01
+                pipe.multi()
+                pipe.zremrangebyscore(key, '-inf', now - 60)
+                pipe.zadd(key, {uuid.uuid4().hex: now})
+                pipe.expire(key, 120)
+                pipe.execute()
+                return 0
+            except WatchError:
+                # 计数在读取后被其他实例修改，稍后重试
+                return 0.01
+
+    def acquire(self, upstream, deadline=None):
+        if self.limit_per_minute <= 0: return
+        key = f"{self.prefix}ratelimit:{upstream}"
+        while True:
+            now = time.time()
+            wait = self._try_acquire(key, now)
+            if wait <= 0: return
+            if deadline is not None and now + wait > deadline:
+                raise UpstreamBusyError(f"上游 {upstream} 已达速率上限，限流等待超时")
+            time.sleep(wait + random.uniform(0, self.max_jitter))
+
+class CoordinationBackend:
+    def __init__(self, name, job_queue, result_cache, rate_limiter, client=None):
+        self.name = name
+        self.client = client
+        self.job_queue = job_queue
+        self.result_cache = result_cache
+        self.rate_limiter = rate_limiter
+
+def _create_memory_backend():
+    return CoordinationBackend('memory',
+                               MemoryJobQueue(UPSTREAM_MAX_CONCURRENCY),
+                               MemoryResultCache(RESULT_CACHE_TTL, RESULT_CACHE_MAX_ENTRIES),
+                               MemoryRateLimiter(UPSTREAM_RATE_LIMIT_RPM))
+
+def _create_redis_backend(client):
+    return CoordinationBackend('redis',
+                               RedisJobQueue(client, REDIS_KEY_PREFIX, UPSTREAM_MAX_CONCURRENCY, JOB_LEASE_SECONDS),
+                               RedisResultCache(client, REDIS_KEY_PREFIX, RESULT_CACHE_TTL),
+                               RedisRateLimiter(client, REDIS_KEY_PREFIX, UPSTREAM_RATE_LIMIT_RPM),
+                               client)
+
+def _create_redis_client(redis, url):
+    # redis-py 默认不设超时，Redis 被黑洞或挂起时调用会无限阻塞，降级逻辑也无从触发
+    return redis.Redis.from_url(url, socket_connect_timeout=REDIS_SOCKET_TIMEOUT, socket_timeout=REDIS_SOCKET_TIMEOUT)
+
+def _create_coordination_backend():
+    if COORDINATION_BACKEND != 'redis':
+        return _create_memory_backend(), None
+    try:
+        import redis
+    except ImportError:
+        return _create_memory_backend(), "COORDINATION_BACKEND=redis 但未安装 redis 库，已回退到进程内后端。"
+    if not REDIS_URL:
+        return _create_memory_backend(), "COORDINATION_BACKEND=redis 但未设置 REDIS_URL，已回退到进程内后端。"
+    try:
+        client = _create_redis_client(redis, REDIS_URL)
+    except ValueError as e:
+        return _create_memory_backend(), f"REDIS_URL ({REDIS_URL}) 无效: {e}，已回退到进程内后端。"
+    return _create_redis_backend(client), None
+
+COORDINATION, COORDINATION_ERROR = _create_coordination_backend()
+
+@contextmanager
+def _job_slot(upstream, deadline):
+    # 协调后端故障时降级为不排队直接执行，避免 Redis 不可用导致所有请求失败
+    slot = COORDINATION.job_queue.slot(upstream, deadline)
+    acquired = False
+    try:
+        slot.__enter__()
+        acquired = True
+    except UpstreamBusyError:
+        raise
+    except Exception as e:
+        print(f"协调后端排队失败，本次请求不受并发约束: {type(e).__name__} - {e}")
+    try:
+        yield
+    finally:
+        if acquired:
+            try:
+                slot.__exit__(None, None, None)
+            except Exception as e:
+                print(f"协调后端释放槽位失败: {type(e).__name__} - {e}")
+
+def _post_upstream(upstream, session, url, **kwargs):
+    # 所有上游调用统一经过全局限流与任务队列，多个实例共享同一速率与并发配额
+    # 先获取限流配额再占用槽位，避免限流等待期间占着槽位阻塞其他请求
+    # 两者合计最多等待 UPSTREAM_WAIT_TIMEOUT 秒，超时抛出 UpstreamBusyError
+    deadline = time.time() + UPSTREAM_WAIT_TIMEOUT
+    try:
+        COORDINATION.rate_limiter.acquire(upstream, deadline)
+    except UpstreamBusyError:
+        raise
+    except Exception as e:
+        print(f"协调后端限流失败，本次请求不受限流约束: {type(e).__name__} - {e}")
+    with _job_slot(upstream, deadline):
+        return session.post(url, **kwargs)
+
+def _result_cache_key(payload):
+    # 以完整请求体(模型、提示词、文本、温度)的哈希作为缓存键，相同输入在所有实例间去重
+    serialized = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+def _cache_get(key):
+    # 缓存仅用于加速，读取失败按未命中处理
+    try:
+        return COORDINATION.result_cache.get(key)
+    except Exception as e:
+        print(f"结果缓存读取失败，按未命中处理: {type(e).__name__} - {e}")
+        return None
+
+def _cache_set(key, value):
+    try:
+        COORDINATION.result_cache.set(key, value)
+    except Exception as e:
+        print(f"结果缓存写入失败，已忽略: {type(e).__name__} - {e}")
+
 # 智能分块策略函数
 def _split_text_intelligently(text, chunk_size=CHUNK_TARGET_SIZE):
     '''
@@ -227,18 +627,24 @@ def _optimize_chunk_with_retry(chunk_data):
     messages.append({"role": "user", "content": user_content})
     payload = {'model': CALIBRATION_MODEL, 'messages': messages, 'temperature': 0.1}
     headers = {'Authorization': f'Bearer {OPT_API_KEY}', 'Content-Type': 'application/json'}
+    cache_key = _result_cache_key(payload)
+    cached_content = _cache_get(cache_key)
+    if cached_content:
+        print("校准命中缓存")
+        return {"status": "success", "content": cached_content}
     
     # 重试机制，带有详细日志输出
     for attempt in range(RETRY_ATTEMPTS):
         try:
             print(f"校准API调用 (尝试 {attempt + 1}/{RETRY_ATTEMPTS})")
-            response = requests.post(OPT_API_URL, headers=headers, json=payload, timeout=300)
+            response = _post_upstream('opt', OPT_SESSION, OPT_API_URL, headers=headers, json=payload, timeout=300)
             
             if response.status_code == 200:
                 data = response.json()
                 content = data.get('choices', [{}])[0].get('message', {}).get('content', '').strip()
                 if content:
                     print("校准成功")
+                    _cache_set(cache_key, content)
                     return {"status": "success", "content": content}
                 else:
                     return {"status": "error", "message": "API返回空内容"}
@@ -248,6 +654,9 @@ def _optimize_chunk_with_retry(chunk_data):
                 if response.status_code in [400, 401, 403, 429]:
                     return {"status": "error", "message": error_msg}
                 
+        except UpstreamBusyError as e:
+            # 排队或限流已等待到上限，重试只会继续占用线程
+            return {"status": "error", "message": str(e)}
         except requests.exceptions.Timeout:
             error_msg = "请求超时"
         except requests.exceptions.RequestException as e:
@@ -317,16 +726,22 @@ def _summarize_chunk_with_retry(text_chunk):
     messages = [{"role": "system", "content": PROMPT_SUMMARY_MAP}, {"role": "user", "content": text_chunk}]
     payload = {'model': SUMMARY_MODEL, 'messages': messages, 'temperature': 0.1}
     headers = {'Authorization': f'Bearer {OPT_API_KEY}', 'Content-Type': 'application/json'}
+    cache_key = _result_cache_key(payload)
+    cached_content = _cache_get(cache_key)
+    if cached_content: return {"status": "success", "content": cached_content}
     for attempt in range(RETRY_ATTEMPTS):
         try:
-            response = requests.post(OPT_API_URL, headers=headers, json=payload, timeout=300)
+            response = _post_upstream('opt', OPT_SESSION, OPT_API_URL, headers=headers, json=payload, timeout=300)
             if response.status_code == 200:
                 data = response.json()
                 content = data.get('choices', [{}])[0].get('message', {}).get('content', '').strip()
-                if content: return {"status": "success", "content": content}
+                if content:
+                    _cache_set(cache_key, content)
+                    return {"status": "success", "content": content}
                 else: return {"status": "error", "message": "API为Map阶段返回空内容"}
             error_msg = f"API错误 {response.status_code}: {_extract_api_error_message(response)}"
             if response.status_code in [400, 401, 403, 429]: return {"status": "error", "message": error_msg}
+        except UpstreamBusyError as e: return {"status": "error", "message": str(e)}
         except requests.exceptions.Timeout: error_msg = "请求超时"
         except requests.exceptions.RequestException as e: error_msg = f"网络连接错误: {type(e).__name__}"
         if attempt == RETRY_ATTEMPTS - 1: return {"status": "error", "message": error_msg}
@@ -354,15 +769,19 @@ def _perform_summarization(text_to_summarize):
     messages = [{"role": "system", "content": PROMPT_SUMMARY_REDUCE}, {"role": "user", "content": combined_points}]
     payload = {'model': SUMMARY_MODEL, 'messages': messages, 'temperature': 0.2}
     headers = {'Authorization': f'Bearer {OPT_API_KEY}', 'Content-Type': 'application/json'}
+    cache_key = _result_cache_key(payload)
+    cached_summary = _cache_get(cache_key)
+    if cached_summary: return {"status": "success", "summary": cached_summary}
     
     # 添加重试机制，与其他功能保持一致
     for attempt in range(RETRY_ATTEMPTS):
         try:
-            response = requests.post(OPT_API_URL, headers=headers, json=payload, timeout=300)
+            response = _post_upstream('opt', OPT_SESSION, OPT_API_URL, headers=headers, json=payload, timeout=300)
             if response.status_code == 200:
                 data = response.json()
                 final_summary = data.get('choices', [{}])[0].get('message', {}).get('content', '').strip()
                 if final_summary:
+                    _cache_set(cache_key, final_summary)
                     return {"status": "success", "summary": final_summary}
                 else:
                     return {"status": "error", "message": "API为Reduce阶段返回空内容"}
@@ -371,6 +790,8 @@ def _perform_summarization(text_to_summarize):
                 # 对于客户端错误，不进行重试
                 if response.status_code in [400, 401, 403, 429]:
                     return {"status": "error", "message": f"整合摘要失败 ({error_msg})"}
+        except UpstreamBusyError as e:
+            return {"status": "error", "message": f"整合摘要失败 ({e})"}
         except requests.exceptions.Timeout:
             error_msg = "请求超时"
         except requests.exceptions.RequestException as e:
@@ -429,18 +850,24 @@ def _perform_notes_generation(text_to_process):
         'Authorization': f'Bearer {OPT_API_KEY}',
         'Content-Type': 'application/json'
     }
+    cache_key = _result_cache_key(payload)
+    cached_notes = _cache_get(cache_key)
+    if cached_notes:
+        print("笔记生成命中缓存")
+        return {"status": "success", "notes": cached_notes}
     
     # 重试机制
     for attempt in range(RETRY_ATTEMPTS):
         try:
             print(f"笔记生成API调用 (尝试 {attempt + 1}/{RETRY_ATTEMPTS})")
-            response = requests.post(OPT_API_URL, headers=headers, json=payload, timeout=300)
+            response = _post_upstream('opt', OPT_SESSION, OPT_API_URL, headers=headers, json=payload, timeout=300)
             
             if response.status_code == 200:
                 data = response.json()
                 content = data.get('choices', [{}])[0].get('message', {}).get('content', '').strip()
                 if content:
                     print("笔记生成成功")
+                    _cache_set(cache_key, content)
                     return {"status": "success", "notes": content}
                 else:
                     return {"status": "error", "message": "API返回空内容"}
@@ -450,6 +877,9 @@ def _perform_notes_generation(text_to_process):
                 if response.status_code in [400, 401, 403, 429]:
                     return {"status": "error", "message": error_msg}
                 
+        except UpstreamBusyError as e:
+            # 排队或限流已等待到上限，重试只会继续占用线程
+            return {"status": "error", "message": str(e)}
         except requests.exceptions.Timeout:
             error_msg = "请求超时"
         except requests.exceptions.RequestException as e:
@@ -469,6 +899,228 @@ def _perform_notes_generation(text_to_process):
     
     return {"status": "error", "message": "未知错误，已达最大重试次数"}
 
+# =============================================================
+# --- 启动配置校验与上游预热 ---
+# =============================================================
+_upstream_state_lock = threading.Lock()
+_upstream_monitor_lock = threading.Lock()
+_upstream_monitor_started = False
+_upstream_state = {"warmed_up": False, "checked_at": None, "config_errors": [], "upstreams": {}, "models": {}, "coordination": {}}
+
+def _is_valid_url(url):
+    if not url or not url.startswith(('http://', 'https://')): return False
+    try:
+        parsed = urlparse(url)
+        parsed.port # 端口非数字或越界时抛出 ValueError
+    except ValueError:
+        return False
+    return bool(parsed.hostname)
+
+def _is_opt_configured():
+    return bool(OPT_API_KEY or (OPT_API_URL and OPT_API_URL != 'https://api.openai.com/v1/chat/completions') or OPT_MODEL)
+
+def _validate_config():
+    '''
+    校验服务配置，返回 (errors, warnings)
+    errors：会导致核心功能不可用的配置问题，/readyz 据此判定未就绪
+    warnings：仅提示，不影响就绪状态
+    '''
+    errors = list(_ENV_ERRORS)
+    warnings = []
+    if not S2T_API_KEY: errors.append("环境变量 S2T_API_KEY 未设置。")
+    if not _is_valid_url(S2T_API_URL): errors.append(f"环境变量 S2T_API_URL 格式不正确: {S2T_API_URL}。")
+
+    if _is_opt_configured():
+        if not OPT_API_KEY: errors.append("环境变量 OPT_API_KEY 未设置。文本优化功能将无法使用。")
+        if not _is_valid_url(OPT_API_URL): errors.append(f"环境变量 OPT_API_URL ({OPT_API_URL}) 无效或格式不正确。")
+        if OPT_API_KEY and not OPT_MODEL: warnings.append("已设置 OPT_API_KEY 但未设置 OPT_MODEL。")
+        for name, model in (('CALIBRATION_MODEL', CALIBRATION_MODEL), ('SUMMARY_MODEL', SUMMARY_MODEL), ('NOTES_MODEL', NOTES_MODEL)):
+            if not model: errors.append(f"{name} 未设置，且没有可回退的 OPT_MODEL。")
+
+    if COORDINATION_ERROR: errors.append(COORDINATION_ERROR)
+    if not API_ACCESS_TOKEN: warnings.append("环境变量 API_ACCESS_TOKEN 未设置或为空。API封装功能将无法通过认证。")
+    return errors, warnings
+
+def _configured_upstreams():
+    upstreams = []
+    if _is_valid_url(S2T_API_URL): upstreams.append(('s2t', S2T_SESSION, S2T_API_URL))
+    if _is_opt_configured() and _is_valid_url(OPT_API_URL): upstreams.append(('opt', OPT_SESSION, OPT_API_URL))
+    return upstreams
+
+def _configured_probe_models():
+    # 去重后的模型列表，多个功能共用同一模型时只探测一次
+    models = []
+    for model in (CALIBRATION_MODEL, SUMMARY_MODEL, NOTES_MODEL):
+        if model and model not in models: models.append(model)
+    return models
+
+def _check_upstream(session, url):
+    '''
+    预解析域名并通过连接池建立连接
+    只要上游返回任意 HTTP 响应即视为可达，连接会保留在池中供后续请求复用；返回 5xx 时标记为 degraded
+    '''
+    result = {"url": url, "reachable": False}
+    start_time = time.time()
+    try:
+        parsed = urlparse(url)
+        port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+        socket.getaddrinfo(parsed.hostname, port, proto=socket.IPPROTO_TCP)
+        result["dns_ms"] = round((time.time() - start_time) * 1000, 1)
+        response = session.head(url, timeout=UPSTREAM_CHECK_TIMEOUT, allow_redirects=False)
+        result["reachable"] = True
+        result["status_code"] = response.status_code
+        result["degraded"] = response.status_code >= 500
+    except ValueError as e:
+        result["error"] = f"URL无效: {e}"
+    except socket.gaierror as e:
+        result["error"] = f"DNS解析失败: {e}"
+    except requests.exceptions.Timeout:
+        result["error"] = "连接超时"
+    except requests.exceptions.RequestException as e:
+        result["error"] = f"网络连接错误: {type(e).__name__}"
+    result["latency_ms"] = round((time.time() - start_time) * 1000, 1)
+    return result
+
+def _check_coordination_backend():
+    # 协调后端故障时请求会降级为不协调直接执行，因此其状态只做汇报，不参与就绪判定
+    if COORDINATION.client is None: return {"backend": COORDINATION.name, "reachable": True}
+    result = {"backend": COORDINATION.name, "reachable": False}
+    start_time = time.time()
+    try:
+        COORDINATION.client.ping()
+        result["reachable"] = True
+    except Exception as e:
+        result["error"] = f"协调后端连接失败: {type(e).__name__}"
+    result["latency_ms"] = round((time.time() - start_time) * 1000, 1)
+    return result
+
+def _probe_model(model):
+    '''
+    向指定模型发送一个极小的补全请求，提前暴露模型名称错误、鉴权失败与上游冷启动
+    '''
+    payload = {'model': model, 'messages': [{"role": "user", "content": "ping"}], 'max_tokens': 1, 'temperature': 0}
+    headers = {'Authorization': f'Bearer {OPT_API_KEY}', 'Content-Type': 'application/json'}
+    result = {"ok": False}
+    start_time = time.time()
+    try:
+        # 探测请求直接发出，不经过任务队列与限流，避免排队等待超出探测超时并占用业务配额
+        response = OPT_SESSION.post(OPT_API_URL, headers=headers, json=payload, timeout=UPSTREAM_CHECK_TIMEOUT * 3)
+        result["status_code"] = response.status_code
+        if response.status_code == 200:
+            result["ok"] = True
+        else:
+            result["error"] = f"API错误 {response.status_code}: {_extract_api_error_message(response)}"
+    except requests.exceptions.Timeout:
+        result["error"] = "请求超时"
+    except requests.exceptions.RequestException as e:
+        result["error"] = f"网络连接错误: {type(e).__name__}"
+    except Exception as e:
+        result["error"] = f"未知错误: {str(e)}"
+    result["latency_ms"] = round((time.time() - start_time) * 1000, 1)
+    return result
+
+def _run_upstream_checks(probe_models=False):
+    upstreams = {name: _check_upstream(session, url) for name, session, url in _configured_upstreams()}
+    coordination = _check_coordination_backend()
+    models = {}
+    if probe_models and upstreams.get('opt', {}).get('reachable') and OPT_API_KEY:
+        # 探测成功的模型不再重复探测，避免消耗额度；失败的模型按指数退避重新探测，瞬时错误恢复后即可就绪
+        with _upstream_state_lock:
+            previous = dict(_upstream_state["models"])
+        now = time.time()
+        for model in _configured_probe_models():
+            last = previous.get(model)
+            if last and (last["ok"] or last["next_probe_at"] > now): continue
+            result = _probe_model(model)
+            if not result["ok"]:
+                failures = (last or {}).get("failures", 0) + 1
+                result["failures"] = failures
+                result["next_probe_at"] = time.time() + min(UPSTREAM_CHECK_INTERVAL * 2 ** (failures - 1), MODEL_PROBE_MAX_BACKOFF)
+            models[model] = result
+    errors, _ = _validate_config()
+    with _upstream_state_lock:
+        _upstream_state["config_errors"] = errors
+        _upstream_state["upstreams"] = upstreams
+        _upstream_state["coordination"] = coordination
+        _upstream_state["models"].update(models)
+        _upstream_state["checked_at"] = time.time()
+
+def _warm_up_upstreams():
+    print("[Warmup] 开始预热上游连接...")
+    _run_upstream_checks(probe_models=STARTUP_PROBE_MODELS)
+    with _upstream_state_lock:
+        _upstream_state["warmed_up"] = True
+        upstreams = dict(_upstream_state["upstreams"])
+        models = dict(_upstream_state["models"])
+    for name, status in upstreams.items():
+        if status["reachable"] and status["degraded"]:
+            print(f"[Warmup] {name.upper()} 上游可达但返回 {status['status_code']}，耗时 {status['latency_ms']} ms")
+        elif status["reachable"]:
+            print(f"[Warmup] {name.upper()} 上游可达，耗时 {status['latency_ms']} ms")
+        else:
+            print(f"[Warmup] {name.upper()} 上游不可达: {status['error']}")
+    for model, status in models.items():
+        if status["ok"]:
+            print(f"[Warmup] 模型 {model} 探测成功，耗时 {status['latency_ms']} ms")
+        else:
+            print(f"[Warmup] 模型 {model} 探测失败: {status['error']}")
+    print("[Warmup] 预热完成。")
+
+def _upstream_monitor_loop():
+    # 首次执行预热，之后按固定间隔在后台刷新检查结果
+    while True:
+        try:
+            if not _upstream_state["warmed_up"]:
+                _warm_up_upstreams()
+            else:
+                _run_upstream_checks(probe_models=STARTUP_PROBE_MODELS)
+        except Exception as e:
+            print(f"[Warmup] 上游检查发生未知错误: {type(e).__name__} - {e}")
+        time.sleep(UPSTREAM_CHECK_INTERVAL)
+
+def _ensure_upstream_monitor():
+    # 无论通过 __main__ 还是 WSGI 服务器加载，首次调用时启动后台检查线程，且只启动一次
+    global _upstream_monitor_started
+    if _upstream_monitor_started: return
+    with _upstream_monitor_lock:
+        if _upstream_monitor_started: return
+        threading.Thread(target=_upstream_monitor_loop, name='upstream-monitor', daemon=True).start()
+        _upstream_monitor_started = True
+
+def _upstream_snapshot():
+    with _upstream_state_lock:
+        state = json.loads(json.dumps(_upstream_state))
+    ready = state["warmed_up"] and not state["config_errors"]
+    if READINESS_REQUIRE_UPSTREAMS:
+        ready = (ready
+                 and all(s["reachable"] and not s["degraded"] for s in state["upstreams"].values())
+                 and all(s["ok"] for s in state["models"].values()))
+    state["ready"] = ready
+    return state
+
+# =============================================================
+# --- 健康检查路由 ---
+# =============================================================
+@app.before_request
+def start_upstream_monitor():
+    _ensure_upstream_monitor()
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    # 存活检查：进程正常即返回 200，附带最近一次上游检查结果，不主动发起上游请求
+    state = _upstream_snapshot()
+    return jsonify({"status": "ok", "ready": state["ready"], "warmed_up": state["warmed_up"], "checked_at": state["checked_at"], "upstreams": state["upstreams"], "models": state["models"], "coordination": state["coordination"]})
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    # 就绪检查：预热未完成或配置有误时返回 503，供负载均衡避开冷启动或配置错误的实例
+    # 上游连通性与延迟仅在响应体中汇报，除非开启 READINESS_REQUIRE_UPSTREAMS
+    # 只读取后台线程的最近一次检查结果，不在探测请求内发起上游调用
+    state = _upstream_snapshot()
+    body = {"status": "ready" if state["ready"] else "not_ready", "warmed_up": state["warmed_up"], "checked_at": state["checked_at"],
+            "config_errors": state["config_errors"], "upstreams": state["upstreams"], "models": state["models"], "coordination": state["coordination"]}
+    return jsonify(body), (200 if state["ready"] else 503)
+
 # =============================================================
 # --- Web UI 页面服务路由 ---
 # =============================================================
@@ -517,7 +1169,7 @@ def openai_audio_transcriptions():
             s2t_files = {'file': (audio_file.filename, audio_file.stream, audio_file.mimetype)}
             s2t_payload = {'model': S2T_MODEL}
             s2t_headers = {'Authorization': f'Bearer {S2T_API_KEY}'}
-            s2t_response = requests.post(S2T_API_URL, files=s2t_files, data=s2t_payload, headers=s2t_headers, timeout=300)
+            s2t_response = _post_upstream('s2t', S2T_SESSION, S2T_API_URL, files=s2t_files, data=s2t_payload, headers=s2t_headers, timeout=300)
             if s2t_response.status_code != 200:
                 error_details = _extract_api_error_message(s2t_response)
                 raise Exception(f"Upstream S2T service failed with status {s2t_response.status_code}: {error_details}")
@@ -573,7 +1225,7 @@ def transcribe_and_optimize_audio():
         
         print(f"[Transcribe] 正在调用 S2T API: {S2T_API_URL}")
         start_time = time.time()
-        s2t_response = requests.post(S2T_API_URL, files=s2t_files, data=s2t_payload, headers=s2t_headers, timeout=300)
+        s2t_response = _post_upstream('s2t', S2T_SESSION, S2T_API_URL, files=s2t_files, data=s2t_payload, headers=s2t_headers, timeout=300)
         end_time = time.time()
         print(f"[Transcribe] S2T API 响应完毕. 状态码: {s2t_response.status_code}, 耗时: {end_time - start_time:.2f} 秒.")
 
@@ -588,6 +1240,9 @@ def transcribe_and_optimize_audio():
             return jsonify({"error": "S2T 服务未能识别出任何文本。"}), 500
         print("[Transcribe] S2T 文本获取成功.")
 
+    except UpstreamBusyError as e:
+        print(f"[Transcribe] 错误: {e}")
+        return jsonify({"error": str(e)}), 503
     except requests.exceptions.Timeout:
         print(f"[Transcribe] 错误: 调用 S2T API 超时 (超过300秒).")
         return jsonify({"error": "调用 S2T API 超时"}), 500
@@ -648,20 +1303,16 @@ def generate_notes():
 
 # --- 主程序启动入口 ---
 if __name__ == '__main__':
-    # 启动时进行配置检查
-    print("--- S2T 配置检查 ---")
-    if not S2T_API_KEY: print("警告: 环境变量 S2T_API_KEY 未设置。")
-    if not S2T_API_URL.startswith(('http://', 'https://')): print(f"警告: 环境变量 S2T_API_URL 格式不正确: {S2T_API_URL}。")
-    
-    print("\n--- OPT 配置检查 ---")
-    opt_configured_for_check = OPT_API_KEY or (OPT_API_URL and OPT_API_URL != 'https://api.openai.com/v1/chat/completions') or OPT_MODEL
-    if opt_configured_for_check:
-        if not OPT_API_KEY: print("警告: 环境变量 OPT_API_KEY 未设置。文本优化功能将无法使用。")
-        if OPT_API_KEY and (not OPT_API_URL or not OPT_API_URL.startswith(('http://', 'https://'))): print(f"警告: 环境变量 OPT_API_URL ({OPT_API_URL}) 无效或格式不正确。")
-        if OPT_API_KEY and not OPT_MODEL: print("警告: 已设置 OPT_API_KEY 但未设置 OPT_MODEL。")
-        
-        # 检查各功能的专用模型配置
-        print("\n--- 功能专用模型配置检查 ---")
+    # 启动时进行配置校验
+    config_errors, config_warnings = _validate_config()
+    print("--- 配置校验 ---")
+    for error in config_errors: print(f"错误: {error}")
+    for warning in config_warnings: print(f"警告: {warning}")
+    if not config_errors and not config_warnings: print("配置校验通过。")
+
+    # 检查各功能的专用模型配置
+    print("\n--- 功能专用模型配置检查 ---")
+    if _is_opt_configured():
         calibration_custom = os.environ.get('CALIBRATION_MODEL') is not None
         summary_custom = os.environ.get('SUMMARY_MODEL') is not None
         notes_custom = os.environ.get('NOTES_MODEL') is not None
@@ -683,12 +1334,15 @@ if __name__ == '__main__':
     else:
         print("提示: OPT服务未配置，校准、总结和笔记生成功能将不可用。")
 
+    print("\n--- 多实例协调检查 ---")
+    print(f"协调后端: {COORDINATION.name}")
+    print(f"上游全局并发上限: {UPSTREAM_MAX_CONCURRENCY or '不限制'}，全局速率上限: {UPSTREAM_RATE_LIMIT_RPM or '不限制'} 次/分钟")
+
     print("\n--- API 封装功能检查 ---")
-    if not API_ACCESS_TOKEN:
-        print("警告: 环境变量 API_ACCESS_TOKEN 未设置或为空。API封装功能将无法通过认证。")
-    else:
-        print("API封装功能已启用。")
+    if API_ACCESS_TOKEN: print("API封装功能已启用。")
     
     print("\n--------------------\n")
+    # 后台预热上游连接，预热完成前 /readyz 返回 503
+    _ensure_upstream_monitor()
     print(f"服务器正在启动，监听 http://0.0.0.0:5000")
-    serve(app, host='0.0.0.0', port=5000)
+    serve(app, host='0.0.0.0', port=5000, threads=WAITRESS_THREADS)
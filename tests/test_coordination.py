@@ -0,0 +1,282 @@
+import threading
+import time
+
+import fakeredis
+import pytest
+
+import app
+
+
+class FakeClock:
+    '''
+    替换 app.time，使限流窗口切换与缓存过期无需真实等待
+    '''
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(app, 'time', fake)
+    return fake
+
+
+@pytest.fixture
+def redis_client():
+    return fakeredis.FakeRedis()
+
+
+def _run_concurrently(job_queue, jobs=5, duration=0.2):
+    lock = threading.Lock()
+    state = {"active": 0, "peak": 0}
+
+    def job():
+        with job_queue.slot('opt'):
+            with lock:
+                state["active"] += 1
+                state["peak"] = max(state["peak"], state["active"])
+            time.sleep(duration)
+            with lock:
+                state["active"] -= 1
+
+    threads = [threading.Thread(target=job) for _ in range(jobs)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    return state["peak"]
+
+
+# --- 进程内后端 ---
+def test_memory_job_queue_caps_concurrency():
+    assert _run_concurrently(app.MemoryJobQueue(2)) == 2
+
+
+def test_memory_job_queue_unlimited_when_disabled():
+    assert _run_concurrently(app.MemoryJobQueue(0), jobs=3) == 3
+
+
+def test_memory_result_cache_expires_after_ttl(clock):
+    cache = app.MemoryResultCache(ttl=60, max_entries=10)
+    cache.set('k', 'v')
+    assert cache.get('k') == 'v'
+    clock.sleep(61)
+    assert cache.get('k') is None
+
+
+def test_memory_result_cache_evicts_least_recently_used(clock):
+    cache = app.MemoryResultCache(ttl=60, max_entries=2)
+    cache.set('a', '1')
+    cache.set('b', '2')
+    cache.get('a')
+    cache.set('c', '3')
+    assert cache.get('a') == '1'
+    assert cache.get('b') is None
+    assert cache.get('c') == '3'
+
+
+def test_memory_rate_limiter_waits_for_oldest_request_to_expire(clock):
+    limiter = app.MemoryRateLimiter(limit_per_minute=2)
+    start = clock.now
+    limiter.acquire('opt')
+    clock.sleep(10)
+    limiter.acquire('opt')
+    limiter.acquire('opt')
+    assert clock.now == start + 60
+    limiter.acquire('opt')
+    assert clock.now == start + 70
+
+
+def test_memory_rate_limiter_has_no_burst_at_minute_boundary(clock):
+    # 固定窗口会在 59 秒与 61 秒各放行一整份配额，滑动窗口必须等到 119 秒
+    limiter = app.MemoryRateLimiter(limit_per_minute=2)
+    clock.now = 60 * 1000 + 59
+    limiter.acquire('opt')
+    limiter.acquire('opt')
+    clock.now = 60 * 1001 + 1
+    limiter.acquire('opt')
+    assert clock.now == 60 * 1001 + 59
+
+
+# --- Redis 后端（使用 fakeredis 作为本地替身）---
+def test_redis_job_queue_caps_concurrency(redis_client):
+    job_queue = app.RedisJobQueue(redis_client, 'test:', 2, lease_seconds=5, poll_interval=0.01)
+    assert _run_concurrently(job_queue) == 2
+    assert redis_client.zcard('test:running:opt') == 0
+    assert redis_client.zcard('test:queue:opt') == 0
+
+
+def test_redis_job_queue_heartbeat_keeps_long_jobs_leased(redis_client):
+    # 任务执行时间超过租约，心跳续约后仍不能被其他任务挤占
+    job_queue = app.RedisJobQueue(redis_client, 'test:', 1, lease_seconds=0.15, poll_interval=0.01)
+    assert _run_concurrently(job_queue, jobs=3, duration=0.3) == 1
+
+
+def test_redis_job_queue_reclaims_expired_lease(redis_client):
+    # 崩溃实例遗留的执行中条目在心跳超时后被清理，槽位得以释放
+    stale = time.time()
+    redis_client.zadd('test:running:opt', {'crashed': stale})
+    redis_client.zadd('test:heartbeat:opt', {'crashed': stale})
+    job_queue = app.RedisJobQueue(redis_client, 'test:', 1, lease_seconds=0.2, poll_interval=0.01)
+    with job_queue.slot('opt'):
+        assert time.time() - stale >= 0.2
+        assert redis_client.zrank('test:running:opt', 'crashed') is None
+
+
+def test_redis_result_cache_expires_after_ttl(redis_client):
+    cache = app.RedisResultCache(redis_client, 'test:', ttl=1)
+    cache.set('k', '校准结果')
+    assert cache.get('k') == '校准结果'
+    assert 0 < redis_client.pttl('test:cache:k') <= 1000
+    time.sleep(1.1)
+    assert cache.get('k') is None
+
+
+def test_redis_result_cache_disabled_when_ttl_zero(redis_client):
+    cache = app.RedisResultCache(redis_client, 'test:', ttl=0)
+    cache.set('k', 'v')
+    assert cache.get('k') is None
+    assert redis_client.get('test:cache:k') is None
+
+
+def test_redis_rate_limiter_waits_for_oldest_request_to_expire(redis_client, clock):
+    limiter = app.RedisRateLimiter(redis_client, 'test:', limit_per_minute=2, max_jitter=0)
+    start = clock.now
+    limiter.acquire('opt')
+    clock.sleep(10)
+    limiter.acquire('opt')
+    limiter.acquire('opt')
+    assert clock.now == start + 60
+    # 过期记录被清理，集合中只保留窗口内的请求
+    assert redis_client.zcard('test:ratelimit:opt') == 2
+
+
+def test_redis_rate_limiter_has_no_burst_at_minute_boundary(redis_client, clock):
+    limiter = app.RedisRateLimiter(redis_client, 'test:', limit_per_minute=2, max_jitter=0)
+    clock.now = 60 * 1000 + 59
+    limiter.acquire('opt')
+    limiter.acquire('opt')
+    clock.now = 60 * 1001 + 1
+    limiter.acquire('opt')
+    assert clock.now == 60 * 1001 + 59
+
+
+def test_redis_rate_limiter_shared_across_instances(redis_client, clock):
+    # 两个实例共用同一计数，合计请求数受同一上限约束
+    first = app.RedisRateLimiter(redis_client, 'test:', limit_per_minute=2, max_jitter=0)
+    second = app.RedisRateLimiter(redis_client, 'test:', limit_per_minute=2, max_jitter=0)
+    start = clock.now
+    first.acquire('opt')
+    second.acquire('opt')
+    second.acquire('opt')
+    assert clock.now == start + 60
+
+
+# --- 等待上限 ---
+def test_memory_job_queue_times_out_when_full():
+    job_queue = app.MemoryJobQueue(1)
+    with job_queue.slot('opt'):
+        with pytest.raises(app.UpstreamBusyError):
+            with job_queue.slot('opt', deadline=time.time() + 0.05):
+                pass
+    # 超时的等待者已出队，不会占住后续槽位
+    with job_queue.slot('opt', deadline=time.time() + 0.05):
+        pass
+
+
+def test_redis_job_queue_times_out_when_full(redis_client):
+    job_queue = app.RedisJobQueue(redis_client, 'test:', 1, lease_seconds=5, poll_interval=0.01)
+    with job_queue.slot('opt'):
+        with pytest.raises(app.UpstreamBusyError):
+            with job_queue.slot('opt', deadline=time.time() + 0.05):
+                pass
+        assert redis_client.zcard('test:queue:opt') == 0
+
+
+def test_rate_limiters_fail_fast_past_deadline(redis_client, clock):
+    for limiter in (app.MemoryRateLimiter(1), app.RedisRateLimiter(redis_client, 'test:', 1, max_jitter=0)):
+        limiter.acquire('opt')
+        start = clock.now
+        with pytest.raises(app.UpstreamBusyError):
+            limiter.acquire('opt', deadline=clock.now + 30)
+        assert clock.now == start
+
+
+def test_busy_upstream_returns_error_without_retry(monkeypatch, clock):
+    class CountingSession:
+        calls = 0
+
+        def post(self, url, **kwargs):
+            CountingSession.calls += 1
+
+    backend = app.CoordinationBackend('memory', app.MemoryJobQueue(0), app.MemoryResultCache(0, 1), app.MemoryRateLimiter(1))
+    backend.rate_limiter.acquire('opt')
+    monkeypatch.setattr(app, 'COORDINATION', backend)
+    monkeypatch.setattr(app, 'OPT_SESSION', CountingSession())
+    monkeypatch.setattr(app, 'UPSTREAM_WAIT_TIMEOUT', 5)
+    for name, value in (('OPT_API_KEY', 'key'), ('OPT_API_URL', 'https://opt.example/v1'), ('NOTES_MODEL', 'model-a')):
+        monkeypatch.setattr(app, name, value)
+    result = app._perform_notes_generation('hello')
+    assert result["status"] == "error"
+    assert '限流等待超时' in result["message"]
+    assert CountingSession.calls == 0
+
+
+# --- 协调后端故障降级 ---
+def test_coordination_failures_do_not_fail_requests(monkeypatch):
+    class BrokenClient:
+        def __getattr__(self, name):
+            def fail(*args, **kwargs):
+                raise ConnectionError("redis down")
+            return fail
+
+    class FakeSession:
+        def post(self, url, **kwargs):
+            return 'response'
+
+    broken = BrokenClient()
+    backend = app.CoordinationBackend('redis',
+                                      app.RedisJobQueue(broken, 'test:', 1, 5),
+                                      app.RedisResultCache(broken, 'test:', 60),
+                                      app.RedisRateLimiter(broken, 'test:', 5),
+                                      broken)
+    monkeypatch.setattr(app, 'COORDINATION', backend)
+    assert app._cache_get('k') is None
+    app._cache_set('k', 'v')
+    assert app._post_upstream('opt', FakeSession(), 'http://example') == 'response'
+
+
+def test_hanging_redis_times_out_and_degrades(monkeypatch):
+    # 接受连接但从不响应的服务端，模拟被黑洞或挂起的 Redis
+    import socket
+    import redis
+
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(16)
+    try:
+        monkeypatch.setattr(app, 'REDIS_SOCKET_TIMEOUT', 0.2)
+        client = app._create_redis_client(redis, f"redis://127.0.0.1:{server.getsockname()[1]}/0")
+        backend = app.CoordinationBackend('redis',
+                                          app.RedisJobQueue(client, 'test:', 1, 5),
+                                          app.RedisResultCache(client, 'test:', 60),
+                                          app.RedisRateLimiter(client, 'test:', 5),
+                                          client)
+        monkeypatch.setattr(app, 'COORDINATION', backend)
+
+        class FakeSession:
+            def post(self, url, **kwargs):
+                return 'response'
+
+        start = time.time()
+        assert app._cache_get('k') is None
+        assert app._post_upstream('opt', FakeSession(), 'http://example') == 'response'
+        assert app._check_coordination_backend()["reachable"] is False
+        assert time.time() - start < 10
+    finally:
+        server.close()
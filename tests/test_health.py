@@ -0,0 +1,200 @@
+import pytest
+
+import app
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, payload=None):
+        self.status_code = status_code
+        self._payload = payload or {}
+        self.text = str(self._payload)
+
+    def json(self):
+        return self._payload
+
+
+class FakeSession:
+    '''
+    替代上游连接池：head 用于连通性检查，post 用于模型探测
+    '''
+    def __init__(self, head_status=200, post_statuses=(200,)):
+        self.head_status = head_status
+        self.post_statuses = list(post_statuses)
+        self.post_calls = 0
+
+    def head(self, url, **kwargs):
+        if isinstance(self.head_status, Exception): raise self.head_status
+        return FakeResponse(self.head_status)
+
+    def post(self, url, **kwargs):
+        status = self.post_statuses[min(self.post_calls, len(self.post_statuses) - 1)]
+        self.post_calls += 1
+        return FakeResponse(status, {"error": {"message": "rate limited"}} if status != 200 else {})
+
+
+class FakeClock:
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture(autouse=True)
+def configured(monkeypatch):
+    monkeypatch.setattr(app, 'S2T_API_KEY', 's2t-key')
+    monkeypatch.setattr(app, 'S2T_API_URL', 'https://s2t.example/v1/audio/transcriptions')
+    monkeypatch.setattr(app, 'OPT_API_KEY', 'opt-key')
+    monkeypatch.setattr(app, 'OPT_API_URL', 'https://opt.example/v1/chat/completions')
+    monkeypatch.setattr(app, 'OPT_MODEL', 'model-a')
+    monkeypatch.setattr(app, 'CALIBRATION_MODEL', 'model-a')
+    monkeypatch.setattr(app, 'SUMMARY_MODEL', 'model-a')
+    monkeypatch.setattr(app, 'NOTES_MODEL', 'model-a')
+    monkeypatch.setattr(app, 'API_ACCESS_TOKEN', 'token')
+    monkeypatch.setattr(app, '_ENV_ERRORS', [])
+    monkeypatch.setattr(app, 'S2T_SESSION', FakeSession())
+    monkeypatch.setattr(app, 'OPT_SESSION', FakeSession())
+    monkeypatch.setattr(app.socket, 'getaddrinfo', lambda *args, **kwargs: [])
+    monkeypatch.setattr(app, '_upstream_state', {"warmed_up": False, "checked_at": None, "config_errors": [], "upstreams": {}, "models": {}, "coordination": {}})
+    # 测试中不启动后台检查线程，由用例显式触发检查
+    monkeypatch.setattr(app, '_upstream_monitor_started', True)
+
+
+@pytest.fixture
+def client():
+    return app.app.test_client()
+
+
+# --- 配置校验 ---
+@pytest.mark.parametrize('url, expected', [
+    ('https://api.example/v1', True),
+    ('http://api.example:8080/v1', True),
+    ('https://api.example:abc/v1', False),
+    ('https://api.example:99999/v1', False),
+    ('ftp://api.example/v1', False),
+    ('https://', False),
+    (None, False),
+])
+def test_is_valid_url(url, expected):
+    assert app._is_valid_url(url) is expected
+
+
+def test_validate_config_passes_when_fully_configured():
+    assert app._validate_config() == ([], [])
+
+
+def test_validate_config_reports_missing_s2t_key(monkeypatch):
+    monkeypatch.setattr(app, 'S2T_API_KEY', None)
+    errors, _ = app._validate_config()
+    assert any('S2T_API_KEY' in e for e in errors)
+
+
+def test_env_int_falls_back_and_reports_malformed_value(monkeypatch):
+    monkeypatch.setenv('TEST_POOL_SIZE', 'abc')
+    assert app._env_int('TEST_POOL_SIZE', 10) == 10
+    errors, _ = app._validate_config()
+    assert any('TEST_POOL_SIZE' in e for e in errors)
+
+
+# --- 上游检查 ---
+def test_check_upstream_marks_5xx_as_degraded():
+    result = app._check_upstream(FakeSession(head_status=502), 'https://opt.example/v1')
+    assert result["reachable"] is True
+    assert result["degraded"] is True
+
+
+def test_check_upstream_records_connection_error():
+    session = FakeSession(head_status=app.requests.exceptions.ConnectionError())
+    result = app._check_upstream(session, 'https://opt.example/v1')
+    assert result["reachable"] is False
+    assert 'ConnectionError' in result["error"]
+
+
+def test_failed_model_probe_backs_off_then_recovers(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(app, 'time', clock)
+    session = FakeSession(post_statuses=(429, 200))
+    monkeypatch.setattr(app, 'OPT_SESSION', session)
+
+    app._run_upstream_checks(probe_models=True)
+    assert app._upstream_state["models"]["model-a"]["ok"] is False
+    assert app._upstream_state["models"]["model-a"]["failures"] == 1
+
+    # 退避期内不重复探测
+    clock.sleep(app.UPSTREAM_CHECK_INTERVAL / 2)
+    app._run_upstream_checks(probe_models=True)
+    assert session.post_calls == 1
+
+    clock.sleep(app.UPSTREAM_CHECK_INTERVAL)
+    app._run_upstream_checks(probe_models=True)
+    assert session.post_calls == 2
+    assert app._upstream_state["models"]["model-a"]["ok"] is True
+
+    # 探测成功后不再消耗额度
+    clock.sleep(app.MODEL_PROBE_MAX_BACKOFF)
+    app._run_upstream_checks(probe_models=True)
+    assert session.post_calls == 2
+
+
+# --- 健康检查路由 ---
+def test_readyz_not_ready_before_warm_up(client):
+    response = client.get('/readyz')
+    assert response.status_code == 503
+    assert response.get_json()["warmed_up"] is False
+
+
+def test_readyz_not_ready_on_config_error(client, monkeypatch):
+    monkeypatch.setattr(app, 'S2T_API_KEY', None)
+    app._warm_up_upstreams()
+    response = client.get('/readyz')
+    assert response.status_code == 503
+    assert response.get_json()["config_errors"]
+
+
+def test_readyz_ready_after_warm_up(client):
+    app._warm_up_upstreams()
+    response = client.get('/readyz')
+    body = response.get_json()
+    assert response.status_code == 200
+    assert body["status"] == "ready"
+    assert set(body["upstreams"]) == {'s2t', 'opt'}
+    assert all('latency_ms' in s for s in body["upstreams"].values())
+
+
+def test_readyz_ignores_shared_upstream_outage_by_default(client, monkeypatch):
+    monkeypatch.setattr(app, 'OPT_SESSION', FakeSession(head_status=503))
+    app._warm_up_upstreams()
+    response = client.get('/readyz')
+    assert response.status_code == 200
+    assert response.get_json()["upstreams"]["opt"]["degraded"] is True
+
+
+def test_readyz_requires_upstreams_when_opted_in(client, monkeypatch):
+    monkeypatch.setattr(app, 'READINESS_REQUIRE_UPSTREAMS', True)
+    monkeypatch.setattr(app, 'OPT_SESSION', FakeSession(head_status=503))
+    app._warm_up_upstreams()
+    assert client.get('/readyz').status_code == 503
+
+
+def test_healthz_always_ok(client):
+    response = client.get('/healthz')
+    assert response.status_code == 200
+    assert response.get_json()["ready"] is False
+
+
+def test_readyz_reports_but_ignores_coordination_outage(client, monkeypatch):
+    class DownClient:
+        def ping(self):
+            raise ConnectionError("redis down")
+
+    backend = app.CoordinationBackend('redis', None, None, None, DownClient())
+    monkeypatch.setattr(app, 'COORDINATION', backend)
+    monkeypatch.setattr(app, 'READINESS_REQUIRE_UPSTREAMS', True)
+    app._warm_up_upstreams()
+    response = client.get('/readyz')
+    assert response.status_code == 200
+    assert response.get_json()["coordination"]["reachable"] is False
+    assert 'coordination' not in response.get_json()["upstreams"]